@@ -1,108 +1,307 @@
 #!/usr/bin/env python3
 
 import os
+import re
 import sys
 import urllib3
 import argparse
 import requests
 import datetime
+import threading
+import time
+
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None
+
+from itertools import takewhile
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Hard-coded list of parameters to filter by if -p/--params is set:
 ALLOWED_PARAMS = [
-    '?q=', '?s=', '?search=', '?id=', '?lang=', '?keyword=', '?query=',
-    '?page=', '?keywords=', '?year=', '?view=', '?email=', '?type=', '?name=',
-    '?p=', '?month=', '?image=', '?list_type=', '?url=', '?terms=',
-    '?categoryid=', '?key=', '?login=', '?begindate=', '?enddate='
+    'q', 's', 'search', 'id', 'lang', 'keyword', 'query',
+    'page', 'keywords', 'year', 'view', 'email', 'type', 'name',
+    'p', 'month', 'image', 'list_type', 'url', 'terms',
+    'categoryid', 'key', 'login', 'begindate', 'enddate'
 ]
 
+# Matches a whole line (URL) of a CDX page if any of its query parameter names is in
+# ALLOWED_PARAMS: the name starts the query string or follows an '&', and ends at
+# '=', '&', the fragment or the end of the URL.
+PARAM_URLS_RX = re.compile(
+    rb"^[^?\n]*\?(?:[^#&\n]*&)*"
+    rb"(?:" + b"|".join(re.escape(param.encode()) for param in ALLOWED_PARAMS) + rb")"
+    rb"(?:[=&#]|$).*$",
+    re.MULTILINE
+)
+
+# Base CDX query (fields, collapsing duplicates, resume keys for pagination)
+CDX_API_URL = (
+    "http://web.archive.org/cdx/search/cdx"
+    "?fl=original"
+    "&collapse=urlkey"
+    "&showResumeKey=true"
+)
+
+# Reference year for -t/--time, computed once per run
+CURRENT_YEAR = datetime.date.today().year
+
+# On-disk cache for CDX pages (only used if requests_cache is installed)
+CACHE_NAME = ".waybaccino_cache"
+CACHE_EXPIRE_AFTER = 3600
+
+# Number of domains fetched concurrently in multi-target mode
+DOMAIN_WORKERS = 8
+
+# Number of concurrent GET requests sent through the proxy in Phase 2
+PROXY_WORKERS = 16
+
+# Minimum delay between two redraws of the proxy progress bar (seconds)
+PROGRESS_INTERVAL = 0.1
+
+# Caps in-flight proxy requests across all domains
+_PROXY_SLOTS = threading.BoundedSemaphore(PROXY_WORKERS)
+
 # Disable the InsecureRequestWarning that appears when using verify=False
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-def fetch_wayback_urls(domain, years=None, chunk_size=5000, param_filter=False):
+# CDX fetch: retry rate limiting and transient server errors with backoff
+_CDX_ADAPTER = HTTPAdapter(
+    pool_maxsize=DOMAIN_WORKERS,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504])
+)
+_CDX_SESSION = requests.Session()
+_CDX_SESSION.mount("http://", _CDX_ADAPTER)
+_CDX_SESSION.mount("https://", _CDX_ADAPTER)
+
+# Proxy replay: send every URL exactly once. Dead archived hosts are the normal case, and a
+# retry would show up as a duplicate in Burp's history.
+# Through the proxy, HTTPS URLs get one tunnelled pool per target host; keep enough
+# pools around that replaying many hosts (or many domains with -mT) does not evict them.
+_PROXY_ADAPTER = HTTPAdapter(
+    pool_connections=64,
+    pool_maxsize=PROXY_WORKERS,
+    max_retries=0
+)
+_SESSION = requests.Session()
+_SESSION.mount("http://", _PROXY_ADAPTER)
+_SESSION.mount("https://", _PROXY_ADAPTER)
+
+def filter_param_urls(urls):
+    """
+    Keep only the URLs (bytes) with a query parameter from ALLOWED_PARAMS.
+    The whole page is matched in a single regex pass over the joined lines.
+    """
+    return PARAM_URLS_RX.findall(b"\n".join(urls))
+
+
+def get_cdx_session(use_cache=True):
+    """
+    Return the session for CDX requests: an on-disk cached session when requests_cache
+    is installed and caching is wanted (so rerunning the same query skips the network),
+    otherwise the plain _CDX_SESSION. Proxied requests stay on _SESSION and are never
+    served from the cache.
+    """
+    if not use_cache or requests_cache is None:
+        return _CDX_SESSION
+
+    session = requests_cache.CachedSession(
+        CACHE_NAME,
+        backend="sqlite",
+        expire_after=CACHE_EXPIRE_AFTER,
+        allowable_methods=("GET",)
+    )
+    # Same adapter (and retries) as the plain CDX session
+    session.mount("http://", _CDX_ADAPTER)
+    session.mount("https://", _CDX_ADAPTER)
+    return session
+
+
+def fetch_cdx_page(session, cdx_api_url, param_filter=False):
+    """
+    Fetch a single page of the CDX API and parse it line by line.
+
+    With the plain session, lines are parsed as the body streams in. A cached session
+    (requests_cache) reads the whole body before returning it, so parsing and filtering
+    only start once the page is complete.
+
+    Returns:
+        A tuple of (list of URLs (bytes) kept by the filter, resume key or None on the last page).
+    """
+    # Increased timeout to 120s for large queries
+    with session.get(cdx_api_url, stream=True, timeout=120) as response:
+        response.raise_for_status()
+
+        # Plain-text output: one URL per line, then a blank line and the resume key.
+        # URLs stay raw bytes; they are only decoded where a str is needed.
+        lines = response.iter_lines()
+        page_urls = takewhile(bool, lines)
+
+        # Optional parameter filtering, decided once per page rather than per line
+        urls = filter_param_urls(page_urls) if param_filter else list(page_urls)
+
+        resume_key = next(filter(None, lines), None)
+
+    return urls, resume_key.decode("utf-8") if resume_key else None
+
+
+def fetch_wayback_urls(domain, years=None, chunk_size=5000, param_filter=False, session=_CDX_SESSION):
     """
     Fetch archived URLs from the Wayback Machine (CDX API) for a given domain,
     with optional pagination, optional time filtering, and optional parameter filtering.
 
     PHASE 1: We do NOT use a proxy here, so we don't get blocked by Burp.
 
-    Returns:
-        A list of URLs (strings).
-    """
-     # Build the base query (URL, output format, fields, collapsing duplicates)
-    base_url = "http://web.archive.org/cdx/search/cdx"
-    cdx_base_api_url = (
-        f"{base_url}?url={domain}/*"
-        "&output=json"
-        "&fl=original"
-        "&collapse=urlkey"
-    )
-
+    Yields:
+        One list of URLs (bytes) per CDX page, as soon as the page is available.
+    """
     # Optional time filtering
+    time_filter = ""
     if years and years > 0:
-        current_year = datetime.datetime.now().year
-        from_year = current_year - years
-        to_year = current_year
-        cdx_base_api_url += f"&from={from_year}&to={to_year}"
+        time_filter = f"&from={CURRENT_YEAR - years}&to={CURRENT_YEAR}"
 
-    all_filtered_urls = []
-    offset = 0
+    # Everything but the resume key is fixed for the whole domain
+    cdx_base_api_url = f"{CDX_API_URL}&url={domain}/*{time_filter}&limit={chunk_size}"
 
-    while True:
-        cdx_api_url = f"{cdx_base_api_url}&limit={chunk_size}&offset={offset}" # Construct the paginated URL
+    def request_page(resume_key=None):
+        cdx_api_url = cdx_base_api_url
+        if resume_key:
+            cdx_api_url += f"&resumeKey={quote(resume_key, safe='')}" # Continue after the previous page
+        return executor.submit(fetch_cdx_page, session, cdx_api_url, param_filter)
 
-        try:
-            # Increased timeout to 120s for large queries
-            response = requests.get(cdx_api_url, timeout=120)
-            response.raise_for_status()
-            data = response.json()
-        except requests.exceptions.RequestException as e:
-            print(f"[!] Error fetching domain '{domain}' at offset {offset}: {e}", file=sys.stderr)
-            break # Stop fetching on error
+    # Each page hands out the key for the next one; fetch it while the current page is consumed
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        future = request_page()
+        page = 1
 
-        # The first element is usually the header (e.g. ["original"])
-        raw_urls = data[1:] if len(data) > 1 else []
-        if not raw_urls:
-            # No more data
-            break
+        while future:
+            try:
+                chunk_urls, resume_key = future.result()
+            except requests.exceptions.RequestException as e:
+                print(f"[!] Error fetching domain '{domain}' at page {page}: {e}", file=sys.stderr)
+                break # Stop fetching on error
 
-        chunk_urls = [item[0] for item in raw_urls] # Convert from list of lists -> list of strings
+            # No resume key means no more data
+            future = request_page(resume_key) if resume_key else None
+            page += 1
 
-        # Optional parameter filtering
-        if param_filter:
-            chunk_urls = [
-                url for url in chunk_urls
-                if any(param in url for param in ALLOWED_PARAMS)
-            ]
+            if chunk_urls:
+                yield chunk_urls
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
 
-        all_filtered_urls.extend(chunk_urls)
 
-        if len(raw_urls) < chunk_size:
-            break
+def get_url_writer(out_f=None):
+    """
+    Pick the function that emits a non-empty list of URLs (bytes): a single write call
+    to the (binary) output file, or a print to STDOUT if no output file is given.
+    """
+    if out_f is None:
+        def write_urls(urls):
+            print(b"\n".join(urls).decode("utf-8", "replace"))
+    else:
+        def write_urls(urls):
+            out_f.write(b"\n".join(urls) + b"\n")
+
+    return write_urls
 
-        offset += chunk_size
 
-    return all_filtered_urls
+def drop_seen_urls(urls, seen):
+    """
+    Drop URLs that were already emitted earlier in this run (e.g. on a previous page
+    or for another domain). Only the hash of each URL is kept in `seen`.
+    """
+    fresh = []
+    for u in urls:
+        h = hash(u)
+        if h not in seen:
+            seen.add(h)
+            fresh.append(u)
+    return fresh
 
 
 def get_urls_through_proxy(urls, proxy):
     """
-    Phase 2: Sends all URLs via GET request via the specified proxy,
-    but only shows a simple progress bar in the terminal.
+    Phase 2: Sends all URLs via GET request via the specified proxy
+    (PROXY_WORKERS at a time).
+
+    Yields:
+        True or False for each request as it completes, depending on whether it succeeded.
     """
     proxies = {"http": proxy, "https": proxy}
-    total = len(urls)
-    total_ok = 0
 
-    for i, url in enumerate(urls, start=1):
-        print(f"\r    [*] Proxying {i}/{total}...", end="", flush=True)
+    def send(url):
+        with _PROXY_SLOTS:
+            _SESSION.get(url.decode("utf-8"), proxies=proxies, timeout=10, verify=False)
 
-        try:
-            r = requests.get(url, proxies=proxies, timeout=10, verify=False)
-            total_ok += 1
-        except Exception:
-            pass
+    with ThreadPoolExecutor(max_workers=PROXY_WORKERS) as executor:
+        futures = [executor.submit(send, url) for url in urls]
 
-    print(f"\n    [*] Finished proxy requests. Successful: {total_ok} / {total}")
+        for future in as_completed(futures):
+            yield future.exception() is None
+
+
+def process_domain(domain, args, cdx_session, write_urls, lock, seen):
+    """
+    Fetch, write and optionally proxy the archived URLs of a single domain.
+    """
+    with lock:
+        print(f"[+] Fetching archived URLs for: {domain}")
+        if args.years:
+            print(f"    [*] Filtering for last {args.years} year(s)")
+        if args.param_filter:
+            print(f"    [*] Only URLs with known query parameters")
+
+        if args.burp_proxy:
+            print(f"    [*] Sending GET requests to each URL via proxy: {args.burp_proxy}")
+
+    total_urls = 0
+    total_ok = 0
+    total_proxied = 0
+    next_redraw = 0.0
+
+    # Stream each page to the output (and the optional Phase 2) as it arrives
+    for urls in fetch_wayback_urls(
+        domain=domain,
+        years=args.years,
+        chunk_size=args.chunk_size,
+        param_filter=args.param_filter,
+        session=cdx_session
+    ):
+        with lock:
+            urls = drop_seen_urls(urls, seen)
+            if not urls:
+                continue
+            write_urls(urls)
+        total_urls += len(urls)
+
+        if args.burp_proxy:
+            # One progress bar for the whole domain; its total grows as pages arrive
+            for ok in get_urls_through_proxy(urls, args.burp_proxy):
+                total_proxied += 1
+                total_ok += ok
+
+                # Redraw at most every PROGRESS_INTERVAL, and always once a page is done.
+                # The bar goes to STDERR so it never ends up inside URL lines on STDOUT.
+                now = time.monotonic()
+                if now >= next_redraw or total_proxied == total_urls:
+                    with lock:
+                        print(f"\r    [*] Proxying {domain}: {total_proxied}/{total_urls}...", end="", flush=True, file=sys.stderr)
+                    next_redraw = now + PROGRESS_INTERVAL
+
+    if total_proxied:
+        with lock:
+            print(file=sys.stderr)
+
+    with lock:
+        print(f"    [*] Total URLs collected for {domain}: {total_urls}")
+        if args.burp_proxy:
+            print(f"    [*] Finished proxy requests for {domain}. Successful: {total_ok} / {total_urls}")
 
 
 def main():
@@ -118,6 +317,7 @@ def main():
     parser.add_argument("-c", "--chunk-size", type=int, dest="chunk_size", required=False, default=5000, help="Number of results per request (default: 5000). Lower it if you get timeouts.")
     parser.add_argument("-p", "--params", action="store_true", dest="param_filter", required=False, help="Only output URLs that contain at least one known query parameter.")
     parser.add_argument("-bp","--burp-proxy", type=str, dest="burp_proxy", required=False, default=None, help="Send traffic to burp suite proxy.")
+    parser.add_argument("--no-cache", action="store_true", dest="no_cache", required=False, help="Do not use the on-disk cache of CDX responses (requires requests_cache).")
 
     args = parser.parse_args()
 
@@ -129,34 +329,7 @@ def main():
 
     # Single target
     if args.single_target:
-        domain = args.single_target.strip()
-        print(f"[+] Fetching archived URLs for: {domain}")
-
-        if args.years:
-            print(f"    [*] Filtering for last {args.years} year(s)")
-        if args.param_filter:
-            print(f"    [*] Only URLs with known query parameters")
-
-        urls = fetch_wayback_urls(
-            domain=domain,
-            years=args.years,
-            chunk_size=args.chunk_size,
-            param_filter=args.param_filter
-        )
-        print(f"    [*] Total URLs collected: {len(urls)}")
-
-        if args.output_file:
-            with open(args.output_file, "a", encoding="utf-8") as f:
-                for u in urls:
-                    f.write(u + "\n")
-        else:
-            for u in urls:
-                print(u)
-
-        # Optional Phase 2
-        if args.burp_proxy:
-            print(f"    [*] Sending GET requests to each URL via proxy: {args.burp_proxy}")
-            get_urls_through_proxy(urls, args.burp_proxy)
+        domains = [args.single_target.strip()]
 
     # Multiple targets
     if args.multiple_targets:
@@ -167,32 +340,36 @@ def main():
         with open(input_file, "r", encoding="utf-8") as f:
             domains = [line.strip() for line in f if line.strip()]
 
-        for domain in domains:
-            print(f"[+] Fetching archived URLs for: {domain}")
-            if args.years:
-                print(f"    [*] Filtering for last {args.years} year(s)")
-            if args.param_filter:
-                print(f"    [*] Only URLs with known query parameters")
-
-            urls = fetch_wayback_urls(
-                domain=domain,
-                years=args.years,
-                chunk_size=args.chunk_size,
-                param_filter=args.param_filter
-            )
-            print(f"    [*] Total URLs collected: {len(urls)}")
-
-            if args.output_file:
-                with open(args.output_file, "a", encoding="utf-8") as out_f:
-                    for u in urls:
-                        out_f.write(u + "\n")
-            else:
-                for u in urls:
-                    print(u)
-
-            if args.burp_proxy:
-                print(f"    [*] Sending GET requests to each URL via proxy: {args.burp_proxy}")
-                get_urls_through_proxy(urls, args.burp_proxy)
+    # Open the output file once for all domains, with a large write buffer
+    out_f = open(args.output_file, "ab", buffering=1 << 20) if args.output_file else None
+
+    write_urls = get_url_writer(out_f)
+
+    # Serializes output (file or STDOUT) between domains fetched concurrently
+    lock = threading.Lock()
+
+    # Hashes of all URLs emitted so far, shared by all domains
+    seen = set()
+
+    # Only created now, so --help and --no-cache runs leave no cache file behind
+    cdx_session = get_cdx_session(use_cache=not args.no_cache)
+
+    executor = ThreadPoolExecutor(max_workers=min(DOMAIN_WORKERS, len(domains) or 1))
+    try:
+        list(executor.map(lambda domain: process_domain(domain, args, cdx_session, write_urls, lock, seen), domains))
+    except KeyboardInterrupt:
+        # Stop right away instead of waiting for the domains still running; keep what was written so far
+        executor.shutdown(wait=False, cancel_futures=True)
+        with lock:
+            sys.stdout.flush()
+            if out_f:
+                out_f.close()
+        print("\n[!] Interrupted.", file=sys.stderr)
+        os._exit(130)
+    finally:
+        executor.shutdown()
+        if out_f:
+            out_f.close()
 
 
 if __name__ == "__main__":